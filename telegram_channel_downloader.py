@@ -6,11 +6,16 @@ Downloads all media, messages, and files from a given Telegram channel.
 
 import os
 import sys
+import time
+import heapq
+import random
 import asyncio
 import logging
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
+from contextlib import AsyncExitStack, suppress
+from dataclasses import dataclass
+from typing import Optional, Tuple
 
 try:
     from telethon import TelegramClient
@@ -18,7 +23,13 @@ try:
         MessageMediaPhoto,
         MessageMediaDocument,
         MessageMediaWebPage,
-        MessageService
+        MessageService,
+        DocumentAttributeFilename,
+        InputMessagesFilterPhotoVideo,
+        InputMessagesFilterDocument,
+        InputMessagesFilterMusic,
+        InputMessagesFilterRoundVoice,
+        InputMessagesFilterGif
     )
     from telethon.errors import SessionPasswordNeededError, FloodWaitError
 except ImportError:
@@ -26,6 +37,25 @@ except ImportError:
     print("Install it with: pip install telethon")
     sys.exit(1)
 
+# Prefer orjson for messages.json, falling back to the standard library
+try:
+    import orjson
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+try:
+    import aiofiles
+except ImportError:
+    print("Error: aiofiles library not found.")
+    print("Install it with: pip install aiofiles")
+    sys.exit(1)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -37,11 +67,70 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Number of messages whose media downloads are awaited together
+BATCH_SIZE = 500
+
+# Batches fetched ahead of the one currently being logged
+BATCH_QUEUE_SIZE = 2
+
+# Attempts per media download before giving up on rate limits
+MAX_FLOOD_RETRIES = 5
+
+# Subdirectories of the download directory that media is sorted into
+MEDIA_SUBDIRS = ("photos", "videos", "documents", "audio")
+
+# Document MIME type (full or major part) -> media subdirectory
+_DOCUMENT_SUBDIRS = {
+    "video": "videos",
+    "audio": "audio",
+    "application/ogg": "audio"
+}
+
+# Server-side filters used in media-only mode. Telegram has no filter for stickers,
+# so those are not downloaded in this mode
+MEDIA_ONLY_FILTERS = (
+    InputMessagesFilterPhotoVideo,
+    InputMessagesFilterDocument,
+    InputMessagesFilterMusic,
+    InputMessagesFilterRoundVoice,
+    InputMessagesFilterGif
+)
+
+# Entry written to messages.txt for each message
+_MESSAGE_LOG_TEMPLATE = "Message ID: {id}\nDate: {date}\n{text}{media}" + "-" * 80 + "\n\n"
+
+# Longest filename most filesystems accept
+MAX_FILENAME_LENGTH = 255
+
+# Characters that are not allowed in filenames, mapped to '_'
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+
+@dataclass
+class Stats:
+    """Counters reported at the end of a download."""
+    messages: int = 0
+    photos: int = 0
+    videos: int = 0
+    documents: int = 0
+    audio: int = 0
+    skipped: int = 0
+    errors: int = 0
+
+
+async def _next_or_none(iterator):
+    """Return the next item of an async iterator, or None once it is exhausted."""
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
 
 class TelegramChannelDownloader:
     """Download all contents from a Telegram channel."""
 
-    def __init__(self, api_id: int, api_hash: str, phone: str, session_name: str = "downloader"):
+    def __init__(self, api_id: int, api_hash: str, phone: str, session_name: str = "downloader",
+                 max_concurrent_downloads: int = 5, save_entities: bool = True):
         """
         Initialize the Telegram downloader.
 
@@ -50,19 +139,27 @@ class TelegramChannelDownloader:
             api_hash: Telegram API Hash
             phone: Phone number with country code (e.g., +1234567890)
             session_name: Name for the session file
+            max_concurrent_downloads: Maximum number of media downloads running at once
+            save_entities: Store users/chats seen while downloading in the session file
         """
         self.api_id = api_id
         self.api_hash = api_hash
         self.phone = phone
-        self.client = TelegramClient(session_name, api_id, api_hash)
-        self.stats = {
-            'messages': 0,
-            'photos': 0,
-            'videos': 0,
-            'documents': 0,
-            'audio': 0,
-            'errors': 0
-        }
+        self.client = TelegramClient(
+            session_name,
+            api_id,
+            api_hash,
+            receive_updates=False
+        )
+        # Skips an SQLite write for every batch of fetched messages; the session still keeps the login
+        self.client.session.save_entities = save_entities
+        self.stats = Stats()
+        self._sem = asyncio.Semaphore(max_concurrent_downloads)
+        self._mkdir_cache = set()
+        self._media_dirs = {}
+        self._download_tasks = set()
+        self._messages_logged = 0
+        self._flood_pause_until = 0.0
 
     async def connect(self):
         """Connect to Telegram and authenticate."""
@@ -81,88 +178,278 @@ class TelegramChannelDownloader:
 
         logger.info("Successfully connected to Telegram")
 
-    def sanitize_filename(self, filename: str) -> str:
+    def _sanitize_filename(self, filename: str) -> str:
         """Sanitize filename to remove invalid characters."""
-        invalid_chars = '<>:"/\\|?*'
-        for char in invalid_chars:
-            filename = filename.replace(char, '_')
-        return filename[:255]  # Limit filename length
+        return filename.translate(_SANITIZE_TABLE)[:MAX_FILENAME_LENGTH]
 
-    def create_download_directory(self, channel_name: str) -> Path:
+    def _create_download_directory(self, channel_name: str, output_dir: Optional[str] = None) -> Path:
         """Create directory structure for downloads."""
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        safe_channel_name = self._sanitize_filename(channel_name)
-        base_dir = Path(f"downloads/{safe_channel_name}_{timestamp}")
+        if output_dir:
+            base_dir = Path(output_dir)
+        else:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            safe_channel_name = self._sanitize_filename(channel_name)
+            base_dir = Path(f"downloads/{safe_channel_name}_{timestamp}")
 
-        # Create subdirectories
-        (base_dir / "photos").mkdir(parents=True, exist_ok=True)
-        (base_dir / "videos").mkdir(parents=True, exist_ok=True)
-        (base_dir / "documents").mkdir(parents=True, exist_ok=True)
-        (base_dir / "audio").mkdir(parents=True, exist_ok=True)
-        (base_dir / "messages").mkdir(parents=True, exist_ok=True)
+        # Media subdirectories are created on first use
+        self._ensure_dir(os.fspath(base_dir / "messages"))
 
         return base_dir
 
-    async def download_media(self, message, base_dir: Path) -> Optional[str]:
-        """Download media from a message."""
-        try:
-            if message.media:
-                if isinstance(message.media, MessageMediaPhoto):
-                    file_path = base_dir / "photos" / f"photo_{message.id}.jpg"
-                    await self.client.download_media(message, file_path)
-                    self.stats['photos'] += 1
-                    return str(file_path)
-
-                elif isinstance(message.media, MessageMediaDocument):
-                    doc = message.media.document
-
-                    # Determine file type and directory
-                    mime_type = doc.mime_type if hasattr(doc, 'mime_type') else ''
-
-                    if 'video' in mime_type:
-                        subdir = "videos"
-                        self.stats['videos'] += 1
-                    elif 'audio' in mime_type or 'ogg' in mime_type:
-                        subdir = "audio"
-                        self.stats['audio'] += 1
-                    else:
-                        subdir = "documents"
-                        self.stats['documents'] += 1
-
-                    # Get original filename or create one
-                    filename = None
-                    for attr in doc.attributes:
-                        if hasattr(attr, 'file_name'):
-                            filename = self._sanitize_filename(attr.file_name)
-                            break
-
-                    if not filename:
-                        ext = mime_type.split('/')[-1] if '/' in mime_type else 'bin'
-                        filename = f"file_{message.id}.{ext}"
-
-                    file_path = base_dir / subdir / filename
-                    await self.client.download_media(message, file_path)
-                    return str(file_path)
+    def _ensure_dir(self, path: str):
+        """Create a directory once per run."""
+        if path not in self._mkdir_cache:
+            os.makedirs(path, exist_ok=True)
+            self._mkdir_cache.add(path)
 
-            return None
+    async def _download_media(self, message) -> Optional[str]:
+        """Download media from a message, limited by the download semaphore."""
+        async with self._sem:
+            return await self._download_media_unbounded(message)
 
-        except FloodWaitError as e:
-            logger.warning(f"Rate limited. Waiting {e.seconds} seconds...")
-            await asyncio.sleep(e.seconds)
-            return await self._download_media(message, base_dir)
+    async def _save_media(self, message, media_dir: str, filename: str) -> Tuple[str, bool]:
+        """
+        Download a message's media to disk, skipping files already downloaded.
 
-        except Exception as e:
-            logger.error(f"Error downloading media from message {message.id}: {e}")
-            self.stats['errors'] += 1
+        Returns:
+            The file path, and whether it was downloaded in this run
+        """
+        file_path = os.path.join(media_dir, filename)
+        if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+            self.stats.skipped += 1
+            return file_path, False
+
+        self._ensure_dir(media_dir)
+        # Short and unique per message: concurrent downloads may share a filename,
+        # and the final name can already be at the filesystem's length limit
+        part_path = os.path.join(media_dir, f".{message.id}.part")
+        try:
+            if await self.client.download_media(message, part_path) is None:
+                raise ValueError("media is not downloadable")
+            os.replace(part_path, file_path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(part_path)
+            raise
+        return file_path, True
+
+    async def _download_photo(self, message) -> str:
+        """Download a photo into the photos directory."""
+        file_path, downloaded = await self._save_media(
+            message, self._media_dirs["photos"], f"photo_{message.id}.jpg"
+        )
+        if downloaded:
+            self.stats.photos += 1
+        return file_path
+
+    async def _download_document(self, message) -> str:
+        """Download a document into the directory matching its MIME type."""
+        doc = message.media.document
+
+        # Determine file type and directory
+        mime_type = getattr(doc, 'mime_type', None) or ''
+        major, _, minor = mime_type.partition('/')
+
+        subdir = _DOCUMENT_SUBDIRS.get(mime_type) or _DOCUMENT_SUBDIRS.get(major, "documents")
+
+        # Get original filename or create one
+        filename_attr = next(
+            (attr for attr in doc.attributes if isinstance(attr, DocumentAttributeFilename)),
+            None
+        )
+        if filename_attr and filename_attr.file_name:
+            # Prefixed with the message ID so documents sharing a name don't overwrite each other;
+            # only the stem is shortened, so the extension survives the length limit
+            prefix = f"{message.id}_"
+            stem, ext = os.path.splitext(filename_attr.file_name.translate(_SANITIZE_TABLE))
+            ext = ext[:MAX_FILENAME_LENGTH - len(prefix)]
+            filename = prefix + stem[:max(0, MAX_FILENAME_LENGTH - len(prefix) - len(ext))] + ext
+        else:
+            filename = f"file_{message.id}.{minor or 'bin'}"
+
+        file_path, downloaded = await self._save_media(message, self._media_dirs[subdir], filename)
+        if not downloaded:
+            return file_path
+
+        # Counted only once the file is saved, so rate-limit retries are not counted twice
+        if subdir == "videos":
+            self.stats.videos += 1
+        elif subdir == "audio":
+            self.stats.audio += 1
+        else:
+            self.stats.documents += 1
+        return file_path
+
+    # Media type -> download handler
+    _MEDIA_HANDLERS = {
+        MessageMediaPhoto: _download_photo,
+        MessageMediaDocument: _download_document,
+    }
+
+    async def _wait_for_flood_pause(self):
+        """Sleep until any rate limit reported by another download has passed."""
+        delay = self._flood_pause_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay + random.random())
+
+    async def _download_media_unbounded(self, message) -> Optional[str]:
+        """Download media from a message, retrying when rate limited."""
+        handler = self._MEDIA_HANDLERS.get(type(message.media))
+        if handler is None:
             return None
 
-    async def download_channel(self, channel_username: str, limit: Optional[int] = None):
+        for attempt in range(1, MAX_FLOOD_RETRIES + 1):
+            await self._wait_for_flood_pause()
+            try:
+                return await handler(self, message)
+
+            except FloodWaitError as e:
+                self._flood_pause_until = max(self._flood_pause_until, time.monotonic() + e.seconds)
+                if attempt < MAX_FLOOD_RETRIES:
+                    logger.warning(f"Rate limited. Waiting {e.seconds} seconds...")
+
+            except Exception as e:
+                logger.error(f"Error downloading media from message {message.id}: {e}")
+                self.stats.errors += 1
+                return None
+
+        logger.error(f"Giving up on media from message {message.id} after {MAX_FLOOD_RETRIES} rate limits")
+        self.stats.errors += 1
+        return None
+
+    async def _flush_batch(self, pending: list, messages_log, messages_json):
+        """Wait for a batch of scheduled media downloads and log their messages in order."""
+        tasks = [entry[-1] for entry in pending if entry[-1] is not None]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        media_paths = iter(results)
+
+        buf = []
+        json_buf = []
+        for message_id, date, text, message_data, task in pending:
+            media_path = None
+            if task is not None:
+                media_path = next(media_paths)
+                if isinstance(media_path, BaseException):
+                    logger.error(f"Error downloading media from message {message_id}: {media_path}")
+                    self.stats.errors += 1
+                    media_path = None
+            if message_data is not None:
+                message_data['media_path'] = media_path
+                json_buf.append(_json_dumps(message_data))
+
+            # Write to text file
+            buf.append(_MESSAGE_LOG_TEMPLATE.format(
+                id=message_id,
+                date=date,
+                text=f"Text: {text}\n" if text else "",
+                media=f"Media: {media_path}\n" if media_path else ""
+            ))
+
+        await messages_log.write("".join(buf))
+
+        # Records are comma-separated inside the JSON array opened by download_channel
+        if json_buf:
+            if await messages_json.tell() > 2:
+                await messages_json.write(b",\n")
+            await messages_json.write(b",\n".join(json_buf))
+
+        # Progress update, once the batch's media is saved and logged
+        self._messages_logged += len(pending)
+        if pending:
+            logger.info(f"Downloaded {self._messages_logged} messages...")
+
+    async def _iter_messages(self, channel, limit: Optional[int], media_only: bool):
+        """Iterate over channel messages, letting Telegram drop non-media ones when media_only is set."""
+        if not media_only:
+            async for message in self.client.iter_messages(channel, limit=limit):
+                yield message
+            return
+
+        # Each filter yields newest first; merge them by ID so order and limit match normal mode
+        streams = [
+            self.client.iter_messages(channel, limit=limit, filter=message_filter).__aiter__()
+            for message_filter in MEDIA_ONLY_FILTERS
+        ]
+        heap = []
+        for index, stream in enumerate(streams):
+            message = await _next_or_none(stream)
+            if message is not None:
+                heapq.heappush(heap, (-message.id, index, message))
+
+        count = 0
+        last_id = None
+        while heap and (limit is None or count < limit):
+            _, index, message = heapq.heappop(heap)
+            following = await _next_or_none(streams[index])
+            if following is not None:
+                heapq.heappush(heap, (-following.id, index, following))
+
+            # A message can match more than one filter
+            if message.id == last_id:
+                continue
+            last_id = message.id
+            count += 1
+            yield message
+
+    async def _produce_batches(self, channel, limit: Optional[int], save_json: bool,
+                               media_only: bool, queue: asyncio.Queue):
+        """Fetch messages, schedule their media downloads and queue them in batches."""
+        pending = []
+        async for message in self._iter_messages(channel, limit, media_only):
+            # Skip service messages
+            if isinstance(message, MessageService):
+                continue
+
+            self.stats.messages += 1
+
+            # Schedule media download if present
+            task = None
+            if message.media and not isinstance(message.media, MessageMediaWebPage):
+                task = asyncio.ensure_future(self._download_media(message))
+                self._download_tasks.add(task)
+                task.add_done_callback(self._download_tasks.discard)
+
+            # Save message text
+            message_data = None
+            if save_json:
+                message_data = {
+                    'id': message.id,
+                    'date': message.date.isoformat() if message.date else None,
+                    'text': message.text or '',
+                    'media_path': None,
+                    'views': message.views,
+                    'forwards': message.forwards
+                }
+            # Keep only the fields the log needs so the Message itself can be freed
+            pending.append((message.id, message.date, message.text, message_data, task))
+
+            if len(pending) >= BATCH_SIZE:
+                await queue.put(pending)
+                pending = []
+
+        await queue.put(pending)
+        await queue.put(None)
+
+    async def _write_batches(self, queue: asyncio.Queue, messages_log, messages_json):
+        """Log queued batches in order until the producer signals the end with None."""
+        while True:
+            pending = await queue.get()
+            if pending is None:
+                return
+            await self._flush_batch(pending, messages_log, messages_json)
+
+    async def download_channel(self, channel_username: str, limit: Optional[int] = None,
+                               output_dir: Optional[str] = None, save_json: bool = True,
+                               media_only: bool = False):
         """
         Download all contents from a channel.
 
         Args:
             channel_username: Channel username (with or without @)
             limit: Maximum number of messages to download (None for all)
+            output_dir: Existing download directory to resume into (None for a new one)
+            save_json: Also write messages.json alongside messages.txt
+            media_only: Only fetch messages that carry photos, videos, documents, audio or GIFs
         """
         try:
             await self.connect()
@@ -181,73 +468,69 @@ class TelegramChannelDownloader:
                 return
 
             # Create download directory
-            base_dir = self._create_download_directory(channel.title or channel_username)
+            base_dir = self._create_download_directory(channel.title or channel_username, output_dir)
             logger.info(f"Saving to: {base_dir}")
+            self._media_dirs = {subdir: os.fspath(base_dir / subdir) for subdir in MEDIA_SUBDIRS}
 
-            # Create messages log file
+            # Create messages log file. Logs are written to .part files and only replace
+            # the logs of a resumed run once this run succeeds
             messages_file = base_dir / "messages" / "messages.txt"
             messages_json_file = base_dir / "messages" / "messages.json"
-
-            import json
-            messages_data = []
-
-            with open(messages_file, 'w', encoding='utf-8') as f:
-                f.write(f"Channel: {channel.title or channel_username}\n")
-                f.write(f"Download started: {datetime.now()}\n")
-                f.write("=" * 80 + "\n\n")
-
-            # Download messages
-            logger.info("Starting download...")
-            async for message in self.client.iter_messages(channel, limit=limit):
-                # Skip service messages
-                if isinstance(message, MessageService):
-                    continue
-
-                self.stats['messages'] += 1
-
-                # Download media if present
-                media_path = None
-                if message.media and not isinstance(message.media, MessageMediaWebPage):
-                    media_path = await self._download_media(message, base_dir)
-
-                # Save message text
-                message_data = {
-                    'id': message.id,
-                    'date': message.date.isoformat() if message.date else None,
-                    'text': message.text or '',
-                    'media_path': media_path,
-                    'views': message.views,
-                    'forwards': message.forwards
-                }
-                messages_data.append(message_data)
-
-                # Write to text file
-                with open(messages_file, 'a', encoding='utf-8') as f:
-                    f.write(f"Message ID: {message.id}\n")
-                    f.write(f"Date: {message.date}\n")
-                    if message.text:
-                        f.write(f"Text: {message.text}\n")
-                    if media_path:
-                        f.write(f"Media: {media_path}\n")
-                    f.write("-" * 80 + "\n\n")
-
-                # Progress update
-                if self.stats['messages'] % 100 == 0:
-                    logger.info(f"Downloaded {self.stats['messages']} messages...")
-
-            # Save JSON
-            with open(messages_json_file, 'w', encoding='utf-8') as f:
-                json.dump(messages_data, f, indent=2, ensure_ascii=False)
+            messages_part = messages_file.with_name(messages_file.name + '.part')
+            messages_json_part = messages_json_file.with_name(messages_json_file.name + '.part')
+
+            async with AsyncExitStack() as stack:
+                f = await stack.enter_async_context(
+                    aiofiles.open(messages_part, 'w', encoding='utf-8', buffering=1 << 20)
+                )
+                fj = None
+                if save_json:
+                    fj = await stack.enter_async_context(
+                        aiofiles.open(messages_json_part, 'wb', buffering=1 << 20)
+                    )
+                    await fj.write(b"[\n")
+                    # Close the array even if the download fails, so messages.json stays valid
+                    stack.push_async_callback(fj.write, b"\n]\n")
+
+                await f.write(
+                    f"Channel: {channel.title or channel_username}\n"
+                    f"Download started: {datetime.now()}\n"
+                    + "=" * 80 + "\n\n"
+                )
+
+                # Fetch messages while earlier batches finish downloading and get logged
+                logger.info("Starting download...")
+                queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+                tasks = [
+                    asyncio.ensure_future(self._produce_batches(
+                        channel, limit, fj is not None, media_only, queue
+                    )),
+                    asyncio.ensure_future(self._write_batches(queue, f, fj))
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # Stop scheduled downloads too, before the client is disconnected
+                    tasks.extend(self._download_tasks)
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+
+            os.replace(messages_part, messages_file)
+            if save_json:
+                os.replace(messages_json_part, messages_json_file)
 
             # Print statistics
             logger.info("\n" + "=" * 50)
             logger.info("Download completed!")
-            logger.info(f"Total messages: {self.stats['messages']}")
-            logger.info(f"Photos: {self.stats['photos']}")
-            logger.info(f"Videos: {self.stats['videos']}")
-            logger.info(f"Documents: {self.stats['documents']}")
-            logger.info(f"Audio files: {self.stats['audio']}")
-            logger.info(f"Errors: {self.stats['errors']}")
+            logger.info(f"Total messages: {self.stats.messages}")
+            logger.info(f"Photos: {self.stats.photos}")
+            logger.info(f"Videos: {self.stats.videos}")
+            logger.info(f"Documents: {self.stats.documents}")
+            logger.info(f"Audio files: {self.stats.audio}")
+            logger.info(f"Skipped (already downloaded): {self.stats.skipped}")
+            logger.info(f"Errors: {self.stats.errors}")
             logger.info(f"Saved to: {base_dir.absolute()}")
             logger.info("=" * 50)
 
@@ -280,6 +563,10 @@ async def main():
         limit_input = input("Enter message limit (press Enter for all messages): ").strip()
         limit = int(limit_input) if limit_input else None
 
+        output_dir = input("Enter a previous download directory to resume (press Enter for a new one): ").strip()
+        save_json = input("Also save messages as JSON? [Y/n]: ").strip().lower() != 'n'
+        media_only = input("Download media messages only? [y/N]: ").strip().lower() == 'y'
+
         # Validate inputs
         if not all([api_id, api_hash, phone, channel]):
             print("Error: All fields are required!")
@@ -298,7 +585,7 @@ async def main():
     downloader = TelegramChannelDownloader(api_id, api_hash, phone)
 
     try:
-        await downloader.download_channel(channel, limit)
+        await downloader.download_channel(channel, limit, output_dir or None, save_json, media_only)
     except KeyboardInterrupt:
         print("\n\nDownload cancelled by user")
     except Exception as e:
@@ -306,8 +593,20 @@ async def main():
 
 
 if __name__ == "__main__":
+    # Use the faster libuv-based event loop when available
+    run = asyncio.run
+    try:
+        import uvloop
+        if hasattr(uvloop, 'run'):
+            run = uvloop.run
+        else:
+            # uvloop < 0.18 has no run(); install() is deprecated in newer releases
+            uvloop.install()
+    except ImportError:
+        pass
+
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         print("\n\nExiting...")
         sys.exit(0)